@@ -1,10 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import re
+import time
 import uuid
 import json
+import queue
+import sqlite3
+import threading
+import unicodedata
+from collections import defaultdict, deque
+from statistics import median
+from difflib import SequenceMatcher
 from dotenv import load_dotenv
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required
+import numpy as np
 import pandas as pd
 from PIL import Image
 from flask import Flask, render_template, request, jsonify, send_file, redirect, send_from_directory
@@ -15,6 +25,11 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
 from google.cloud import vision
 
+try:
+    import pytesseract  # optional: local OCR backend
+except ImportError:
+    pytesseract = None
+
 # -------------------- Load .env --------------------
 load_dotenv()
 
@@ -41,6 +56,41 @@ client = None
 if not os.getenv("PYTEST_RUNNING"):   # <-- seulement si pas en test
     client = OpenAI(api_key=OPENAI_API_KEY)
 
+# -------------------- Image quality gate --------------------
+# Thresholds for the local pre-OCR check, measured on a 512 px grayscale copy
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "40"))     # Laplacian variance on text tiles
+QUALITY_MIN_BRIGHTNESS = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "40"))   # mean, 0-255
+QUALITY_MAX_BRIGHTNESS = float(os.getenv("QUALITY_MAX_BRIGHTNESS", "225"))  # mean, 0-255
+QUALITY_MAX_CLIPPED = float(os.getenv("QUALITY_MAX_CLIPPED", "0.5"))        # share of crushed/blown pixels
+QUALITY_MIN_TEXT_COVERAGE = float(os.getenv("QUALITY_MIN_TEXT_COVERAGE", "0.02"))  # below: low confidence
+QUALITY_MIN_TEXT_TILES = int(os.getenv("QUALITY_MIN_TEXT_TILES", "2"))  # below: no text at all
+
+# -------------------- OCR backend --------------------
+# Any engine registered in OCR_ENGINES ("vision": Google Cloud Vision, "tesseract":
+# local, works offline) or "auto" (tesseract first, Vision only when local
+# confidence is low). Checked at startup, see check_ocr_backend().
+OCR_BACKEND = os.getenv("OCR_BACKEND", "vision").lower()
+OCR_LOCAL_MIN_CONFIDENCE = float(os.getenv("OCR_LOCAL_MIN_CONFIDENCE", "0.7"))
+OCR_TESSERACT_LANG = os.getenv("OCR_TESSERACT_LANG", "eng+fra")
+
+# -------------------- Model routing --------------------
+# Easy lines go to the fast tier first; failures and low-confidence answers escalate.
+MODEL_TIERS = [
+    ("fast", os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini")),
+    ("large", os.getenv("OPENAI_LARGE_MODEL", "gpt-4o")),
+]
+ROUTING_EASY_MAX_CHARS = int(os.getenv("ROUTING_EASY_MAX_CHARS", "80"))
+ROUTING_MIN_CONFIDENCE = float(os.getenv("ROUTING_MIN_CONFIDENCE", "0.6"))
+
+# -------------------- OCR line deduplication --------------------
+LINE_DEDUP_THRESHOLD = float(os.getenv("LINE_DEDUP_THRESHOLD", "0.85"))
+LINE_DEDUP_MAX_POSTING = 64  # ignore blocking keys shared by too many clusters (e.g. "edition")
+LINE_DEDUP_MIN_TOKEN_OVERLAP = 0.6  # edit similarity is only trusted above this Jaccard score
+ROMAN_NUMERAL = re.compile(r"^m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$")
+VOLUME_KEYWORDS = {"t", "tome", "vol", "volume", "part", "partie", "livre", "book"}
+FRENCH_ELISION = re.compile(r"\b(qu|[cdjlmnst])['’‘`]\s*")
+BOOK_PLACEHOLDERS = {"", "...", "n/a", "unknown", "none", "null"}
+
 # -------------------- Folders --------------------
 UPLOAD_FOLDER = "uploads"
 PROCESSED_FOLDER = "processed"
@@ -96,6 +146,17 @@ class Scan(db.Model):
     image_paths = db.Column(db.Text)  # JSON list
     result_json = db.Column(db.Text)  # JSON list
 
+class UploadSession(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    timestamp = db.Column(
+        db.DateTime,
+        default=lambda: datetime.now().astimezone()
+    )
+    files_json = db.Column(db.Text)  # JSON list of {"name", "size", "path"}
+    scan_id = db.Column(db.Integer, db.ForeignKey('scan.id'), nullable=True)
+    quality_json = db.Column(db.Text)  # JSON list, kept for idempotent finalize replies
+
 with app.app_context():
     db.create_all()
 
@@ -123,6 +184,83 @@ def compress_image(input_path, output_path, max_width=1600, quality=90):
         img = img.resize((max_width, height_size), Image.LANCZOS)
         img.save(output_path, format='JPEG', optimize=True, quality=quality)
 
+def prepare_image(upload_path):
+    name, ext = os.path.splitext(os.path.basename(upload_path))
+    if ext.lower() == ".heic":
+        img_path = os.path.join(PROCESSED_FOLDER, name + ".png")
+        convert_heic_to_png(upload_path, img_path)
+    else:
+        img_path = upload_path
+
+    compressed_path = os.path.join(PROCESSED_FOLDER, name + ".jpg")
+    compress_image(img_path, compressed_path)
+    return compressed_path
+
+# Cheap local check run before paying for OCR and GPT: "ok" is False when the
+# image is too dark, overexposed, blurry or shows no text-like regions.
+def assess_image_quality(image_path, size=512, tile=16):
+    try:
+        with Image.open(image_path) as img:
+            img.draft("L", (size, size))  # JPEG: decode directly at reduced scale
+            img = img.convert("L")
+            img.thumbnail((size, size))
+            gray = np.asarray(img, dtype=np.float32)
+    except Exception as e:
+        # The gate must never block an upload because of its own failure
+        print(f"⚠️ Quality check skipped for {image_path}: {e}")
+        return {"ok": True, "reason": None, "low_confidence": False, "metrics": {}}
+
+    padded = np.pad(gray, 1, mode="edge")
+    laplacian = padded[1:-1, :-2] + padded[1:-1, 2:] + padded[:-2, 1:-1] + padded[2:, 1:-1] - 4 * gray
+
+    histogram = np.bincount(gray.astype(np.uint8).ravel(), minlength=256)
+    brightness = float(gray.mean())
+    clipped = float((histogram[:8].sum() + histogram[248:].sum()) / gray.size)
+
+    # Text shows up as tiles with dense horizontal or vertical gradients. Sharpness is
+    # measured on those tiles only, so a sharp spine on a plain background is not
+    # mistaken for a blurry photo.
+    edges = np.zeros_like(gray)
+    edges[:, 1:] += np.abs(np.diff(gray, axis=1))
+    edges[1:, :] += np.abs(np.diff(gray, axis=0))
+    rows, cols = gray.shape[0] // tile, gray.shape[1] // tile
+    if rows and cols:
+        def to_tiles(a):
+            return a[:rows * tile, :cols * tile].reshape(rows, tile, cols, tile).swapaxes(1, 2)
+        text_tiles = to_tiles(edges).mean(axis=(2, 3)) > 8
+        text_tile_count = int(text_tiles.sum())
+        text_coverage = float(text_tiles.mean())
+        sharpness = float(to_tiles(laplacian)[text_tiles].var()) if text_tile_count else float(laplacian.var())
+    else:
+        text_tile_count, text_coverage = 0, 0.0
+        sharpness = float(laplacian.var())
+
+    metrics = {
+        "sharpness": round(sharpness, 2),
+        "brightness": round(brightness, 2),
+        "clipped": round(clipped, 4),
+        "text_coverage": round(text_coverage, 4),
+    }
+
+    # Only clear failures are rejected; borderline images go to OCR flagged low_confidence
+    reason = None
+    if brightness < QUALITY_MIN_BRIGHTNESS:
+        reason = "too_dark"
+    elif brightness > QUALITY_MAX_BRIGHTNESS:
+        reason = "overexposed"
+    elif text_tile_count < QUALITY_MIN_TEXT_TILES:
+        # No edge-dense region at all: a flat frame is blur, otherwise there is no text
+        reason = "too_blurry" if sharpness < QUALITY_MIN_SHARPNESS else "no_text_detected"
+    elif sharpness < QUALITY_MIN_SHARPNESS:
+        reason = "too_blurry"
+
+    low_confidence = reason is None and (
+        sharpness < 2 * QUALITY_MIN_SHARPNESS
+        or clipped > QUALITY_MAX_CLIPPED
+        or text_coverage < QUALITY_MIN_TEXT_COVERAGE
+    )
+    return {"ok": reason is None, "reason": reason, "low_confidence": low_confidence, "metrics": metrics}
+
 def extract_text_google_vision(image_path):
     vision_client = vision.ImageAnnotatorClient()
     with open(image_path, "rb") as image_file:
@@ -133,11 +271,251 @@ def extract_text_google_vision(image_path):
         raise Exception(f"Google Vision API error: {response.error.message}")
     return response.text_annotations[0].description if response.text_annotations else ""
 
+def tesseract_ocr_pass(img):
+    data = pytesseract.image_to_data(img, lang=OCR_TESSERACT_LANG, output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if not word.strip() or conf < 0:
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+        confidences.append(conf)
+    text = "\n".join(" ".join(words) for _, words in sorted(lines.items()))
+    confidence = sum(confidences) / len(confidences) / 100 if confidences else 0.0
+    return text, confidence
+
+def extract_text_tesseract(image_path):
+    # Spines are usually vertical: also read the image rotated both ways and keep
+    # the orientation Tesseract is most confident about.
+    if pytesseract is None:
+        raise RuntimeError("pytesseract is not installed")
+    best_text, best_confidence = "", 0.0
+    with Image.open(image_path) as img:
+        img = img.convert("L")
+        for angle in (0, 90, 270):
+            text, confidence = tesseract_ocr_pass(img.rotate(angle, expand=True) if angle else img)
+            if confidence > best_confidence:
+                best_text, best_confidence = text, confidence
+            if best_confidence >= OCR_LOCAL_MIN_CONFIDENCE:
+                break
+    return best_text, best_confidence
+
+def check_tesseract():
+    if pytesseract is None:
+        raise RuntimeError("pytesseract is not installed (pip install pytesseract)")
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        raise RuntimeError(f"the tesseract binary is not available: {e}")
+    missing = set(OCR_TESSERACT_LANG.split("+")) - set(pytesseract.get_languages(config=""))
+    if missing:
+        raise RuntimeError(f"missing tesseract language pack(s): {', '.join(sorted(missing))}")
+
+def ocr_vision(image_path):
+    return extract_text_google_vision(image_path), 1.0
+
+def ocr_tesseract(image_path):
+    return extract_text_tesseract(image_path)
+
+# name -> (image_path -> (text, confidence 0-1)); register new engines here
+OCR_ENGINES = {
+    "vision": ocr_vision,
+    "tesseract": ocr_tesseract,
+}
+OCR_ENGINE_CHECKS = {
+    "tesseract": check_tesseract,
+}
+OCR_AUTO_LOCAL, OCR_AUTO_FALLBACK = "tesseract", "vision"
+
+def check_ocr_backend():
+    if OCR_BACKEND != "auto" and OCR_BACKEND not in OCR_ENGINES:
+        choices = ", ".join([*OCR_ENGINES, "auto"])
+        raise ValueError(f"Unknown OCR_BACKEND '{OCR_BACKEND}', expected one of: {choices}")
+    engine = OCR_AUTO_LOCAL if OCR_BACKEND == "auto" else OCR_BACKEND
+    check = OCR_ENGINE_CHECKS.get(engine)
+    if not check:
+        return
+    try:
+        check()
+    except Exception as e:
+        if OCR_BACKEND != "auto":
+            raise RuntimeError(f"OCR_BACKEND={OCR_BACKEND} cannot run: {e}")
+        print(f"⚠️ Local OCR unavailable, every image will use {OCR_AUTO_FALLBACK}: {e}")
+
+check_ocr_backend()
+
+def extract_text(image_path):
+    if OCR_BACKEND != "auto":
+        return OCR_ENGINES[OCR_BACKEND](image_path)[0]
+
+    try:
+        text, confidence = OCR_ENGINES[OCR_AUTO_LOCAL](image_path)
+        if confidence >= OCR_LOCAL_MIN_CONFIDENCE:
+            return text
+        print(f"🔁 Local OCR confidence {confidence:.2f} too low, falling back to {OCR_AUTO_FALLBACK}")
+    except Exception as e:
+        print(f"⚠️ Local OCR failed, falling back to {OCR_AUTO_FALLBACK}: {e}")
+    return OCR_ENGINES[OCR_AUTO_FALLBACK](image_path)[0]
+
+def normalize_ocr_line(line):
+    text = unicodedata.normalize("NFKD", line)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = FRENCH_ELISION.sub(r"\1", text)  # "L'Étranger" -> "letranger", as OCR often reads it
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+def distinguishing_tokens(tokens):
+    # Numbers, roman numerals and a letter after a volume keyword ("Tome B") tell
+    # volumes of a series apart; a bare "l", "d" or "a" is elision/OCR noise
+    found = set()
+    for i, t in enumerate(tokens):
+        after_keyword = i > 0 and tokens[i - 1] in VOLUME_KEYWORDS
+        if any(c.isdigit() for c in t) or (len(t) > 1 and ROMAN_NUMERAL.match(t)) or (len(t) == 1 and after_keyword):
+            found.add(t)
+    return found
+
+def line_similarity(a, b):
+    # a and b are normalized lines: token-set overlap, falling back to edit similarity
+    # for OCR noise only when the token sets nearly match
+    if distinguishing_tokens(a.split()) != distinguishing_tokens(b.split()):
+        return 0.0
+    if a.replace(" ", "") == b.replace(" ", ""):
+        return 1.0  # only the word breaks differ ("l etranger" / "letranger")
+    tokens_a, tokens_b = set(a.split()), set(b.split())
+    union = tokens_a | tokens_b
+    jaccard = len(tokens_a & tokens_b) / len(union) if union else 0.0
+    if jaccard >= LINE_DEDUP_THRESHOLD or jaccard < LINE_DEDUP_MIN_TOKEN_OVERLAP:
+        return jaccard
+    return max(jaccard, SequenceMatcher(None, a, b).ratio())
+
+class LineDeduplicator:
+    # Clusters near-identical OCR lines across the images of one upload. An inverted
+    # index on tokens and 4-char token prefixes limits comparisons to lines that
+    # share a blocking key instead of every pair.
+    def __init__(self, threshold=None):
+        self.threshold = LINE_DEDUP_THRESHOLD if threshold is None else threshold
+        self.clusters = []    # raw lines per cluster
+        self.normalized = []  # normalized first line per cluster
+        self.index = defaultdict(set)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def blocking_keys(normalized):
+        tokens = [t for t in normalized.split() if len(t) >= 3]
+        return set(tokens) | {t[:4] + "*" for t in tokens if len(t) > 4}
+
+    def add(self, line):
+        # Returns (cluster_id, is_new); only new clusters need to be parsed
+        normalized = normalize_ocr_line(line)
+        keys = self.blocking_keys(normalized)
+        with self.lock:
+            candidates = set()
+            for key in keys:
+                posting = self.index.get(key)
+                if posting and len(posting) <= LINE_DEDUP_MAX_POSTING:
+                    candidates |= posting
+
+            best, best_score = None, 0.0
+            for cluster_id in candidates:
+                score = line_similarity(normalized, self.normalized[cluster_id])
+                if score > best_score:
+                    best, best_score = cluster_id, score
+
+            if best is not None and best_score >= self.threshold:
+                self.clusters[best].append(line)
+                return best, False
+
+            cluster_id = len(self.clusters)
+            self.clusters.append([line])
+            self.normalized.append(normalized)
+            for key in keys:
+                self.index[key].add(cluster_id)
+            return cluster_id, True
+
+def is_blank_field(value):
+    return value is None or str(value).strip().lower() in BOOK_PLACEHOLDERS
+
+def merge_duplicate_books(books):
+    # Same ISBN, or same title and author when an ISBN is missing, is the same book;
+    # the first record is kept and its empty fields are filled from the duplicates.
+    merged = []
+    by_isbn = {}
+    by_title = {}
+    for book in books:
+        isbn = "" if is_blank_field(book.get("ISBN")) else re.sub(r"[^0-9X]", "", str(book["ISBN"]).upper())
+        title = "" if is_blank_field(book.get("Title")) else normalize_ocr_line(str(book["Title"]))
+        author = "" if is_blank_field(book.get("Author(s)")) else normalize_ocr_line(str(book["Author(s)"]))
+        title_key = (title, author) if title else None
+
+        target = by_isbn.get(isbn) if isbn else None
+        if target is None and title_key in by_title:
+            candidate = by_title[title_key]
+            candidate_isbn = re.sub(r"[^0-9X]", "", str(candidate.get("ISBN") or "").upper())
+            if not isbn or is_blank_field(candidate.get("ISBN")) or candidate_isbn == isbn:
+                target = candidate
+
+        if target is None:
+            target = dict(book)
+            merged.append(target)
+        else:
+            for field, value in book.items():
+                if is_blank_field(target.get(field)) and not is_blank_field(value):
+                    target[field] = value
+
+        if isbn:
+            by_isbn.setdefault(isbn, target)
+        if title_key:
+            by_title.setdefault(title_key, target)
+    return merged
+
+model_stats_lock = threading.Lock()
+model_stats = {
+    tier: {
+        "model": model,
+        "calls": 0,
+        "failures": 0,
+        "escalations": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "latencies_ms": deque(maxlen=1000),
+    }
+    for tier, model in MODEL_TIERS
+}
+
+def record_model_call(tier, started, usage=None, failed=False, escalated=False):
+    with model_stats_lock:
+        stats = model_stats[tier]
+        stats["calls"] += 1
+        stats["failures"] += int(failed)
+        stats["escalations"] += int(escalated)
+        stats["latencies_ms"].append((time.perf_counter() - started) * 1000)
+        if usage is not None:
+            stats["prompt_tokens"] += usage.prompt_tokens or 0
+            stats["completion_tokens"] += usage.completion_tokens or 0
+
+def model_stats_snapshot():
+    with model_stats_lock:
+        return {
+            tier: {
+                **{k: v for k, v in stats.items() if k != "latencies_ms"},
+                "median_latency_ms": round(median(stats["latencies_ms"]), 1) if stats["latencies_ms"] else None,
+            }
+            for tier, stats in model_stats.items()
+        }
+
+def is_easy_line(line):
+    stripped = line.strip()
+    if len(stripped) > ROUTING_EASY_MAX_CHARS:
+        return False
+    noise = sum(1 for c in stripped if not (c.isalnum() or c.isspace() or c in "-'.,:&()"))
+    return noise / len(stripped) < 0.1
+
 def parse_spine_line(line):
     if len(line.strip()) < 10:
         return None
     prompt = f'''Here is the text found on a book spine:\n"{line}"\n
-Return ONLY a strict JSON like this:
+Return a JSON object like this, where Confidence is your confidence (0 to 1) in the answer:
 
 {{
   "Title": "...",
@@ -145,28 +523,181 @@ Return ONLY a strict JSON like this:
   "Edition": "...",
   "Publisher": "...",
   "ISBN": "...",
-  "Year": "..."
+  "Year": "...",
+  "Confidence": 0.0
 }}'''
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a librarian assistant. Reply ONLY with a strictly valid JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            # For this model, temperature must be the default (1). Do not change it.
-        )
-        content = response.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.endswith("```"):
-            content = content[:-3]
-        data = json.loads(content)
+    tiers = MODEL_TIERS if is_easy_line(line) else MODEL_TIERS[1:]
+    for i, (tier, model) in enumerate(tiers):
+        last_tier = i == len(tiers) - 1
+        started = time.perf_counter()
+        try:
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "You are a librarian assistant. Reply ONLY with a strictly valid JSON."},
+                    {"role": "user", "content": prompt}
+                ],
+                response_format={"type": "json_object"},
+                # For this model, temperature must be the default (1). Do not change it.
+            )
+            data = json.loads(response.choices[0].message.content)
+            if not isinstance(data, dict):
+                raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        except Exception as e:
+            record_model_call(tier, started, failed=True, escalated=not last_tier)
+            print(f"❌ GPT error ({model}) for '{line[:20]}...': {e}")
+            continue
+
+        try:
+            confidence = float(data.pop("Confidence", None))
+        except (TypeError, ValueError):
+            confidence = 0.0  # missing or unreadable confidence counts as low
+        confident = confidence >= ROUTING_MIN_CONFIDENCE and not is_blank_field(data.get("Title"))
+        escalate = not confident and not last_tier
+        record_model_call(tier, started, response.usage, escalated=escalate)
+        if escalate:
+            continue
+
         data["Raw OCR Text"] = line
         return data
+    return None
+
+# -------------------- Search index --------------------
+# Full-text index over the books of every Scan, kept in its own SQLite file so
+# FTS5 is available whatever DATABASE_URL points to. Rows are added when a Scan
+# is written and removed with it; triggers keep the FTS5 table in sync.
+# Writes go through one connection under a lock; searches use pooled read
+# connections so they never wait on each other or on indexing (WAL mode).
+class BookSearchIndex:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()  # writes only
+        self.readers = queue.SimpleQueue()
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS indexed_books (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    scan_id INTEGER NOT NULL,
+                    title TEXT, author TEXT, publisher TEXT, isbn TEXT,
+                    owner TEXT NOT NULL,
+                    book_json TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS indexed_books_scan ON indexed_books (scan_id);
+                -- every indexed scan, including those with no books
+                CREATE TABLE IF NOT EXISTS indexed_scans (scan_id INTEGER PRIMARY KEY);
+                CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                    title, author, publisher, isbn, owner,
+                    content='indexed_books', content_rowid='id',
+                    prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS indexed_books_ai AFTER INSERT ON indexed_books BEGIN
+                    INSERT INTO books_fts (rowid, title, author, publisher, isbn, owner)
+                    VALUES (new.id, new.title, new.author, new.publisher, new.isbn, new.owner);
+                END;
+                CREATE TRIGGER IF NOT EXISTS indexed_books_ad AFTER DELETE ON indexed_books BEGIN
+                    INSERT INTO books_fts (books_fts, rowid, title, author, publisher, isbn, owner)
+                    VALUES ('delete', old.id, old.title, old.author, old.publisher, old.isbn, old.owner);
+                END;
+            """)
+
+    @staticmethod
+    def field(book, key):
+        return "" if is_blank_field(book.get(key)) else str(book[key])
+
+    def add_scan(self, scan_id, user_id, books):
+        rows = []
+        for book in books:
+            isbn = self.field(book, "ISBN")
+            rows.append((
+                user_id, scan_id,
+                self.field(book, "Title"), self.field(book, "Author(s)"), self.field(book, "Publisher"),
+                f"{isbn} {re.sub(r'[^0-9Xx]', '', isbn)}".strip(),
+                f"u{user_id}", json.dumps(book)
+            ))
+        with self.lock, self.conn:
+            if not self.conn.execute("INSERT OR IGNORE INTO indexed_scans VALUES (?)", (scan_id,)).rowcount:
+                return  # already indexed
+            self.conn.executemany(
+                "INSERT INTO indexed_books (user_id, scan_id, title, author, publisher, isbn, owner, book_json) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def remove_scans(self, scan_ids):
+        with self.lock, self.conn:
+            params = [(i,) for i in scan_ids]
+            self.conn.executemany("DELETE FROM indexed_books WHERE scan_id = ?", params)
+            self.conn.executemany("DELETE FROM indexed_scans WHERE scan_id = ?", params)
+
+    def read(self, sql, params=()):
+        if self.path == ":memory:":
+            # A private in-memory database only exists on the writer connection
+            with self.lock:
+                return self.conn.execute(sql, params).fetchall()
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self.readers.put(conn)
+
+    def indexed_scan_ids(self):
+        return {scan_id for (scan_id,) in self.read("SELECT scan_id FROM indexed_scans")}
+
+    def search(self, user_id, query, page=1, per_page=20):
+        # Every term is a prefix match; the owner column restricts hits to the user
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return 0, []
+        match = "{title author publisher isbn}: (" + " ".join(f'"{t}"*' for t in terms) + f') AND owner:"u{user_id}"'
+        total = self.read("SELECT count(*) FROM books_fts WHERE books_fts MATCH ?", (match,))[0][0]
+        rows = self.read(
+            "SELECT b.scan_id, b.book_json, bm25(books_fts, 10.0, 5.0, 2.0, 8.0, 0.0) AS score "
+            "FROM books_fts JOIN indexed_books b ON b.id = books_fts.rowid "
+            "WHERE books_fts MATCH ? ORDER BY score LIMIT ? OFFSET ?",
+            (match, per_page, (page - 1) * per_page)
+        )
+        return total, [
+            {"scan_id": scan_id, "book": json.loads(book_json), "score": round(-score, 4)}
+            for scan_id, book_json, score in rows
+        ]
+
+if os.getenv("PYTEST_RUNNING"):   # tests never touch the on-disk index
+    search_index = BookSearchIndex(":memory:")
+else:
+    os.makedirs(app.instance_path, exist_ok=True)
+    search_index = BookSearchIndex(os.getenv("SEARCH_INDEX_PATH", os.path.join(app.instance_path, "search_index.db")))
+
+def index_scan(scan, books):
+    try:
+        search_index.add_scan(scan.id, scan.user_id, books)
     except Exception as e:
-        print(f"❌ GPT error for '{line[:20]}...': {e}")
-        return None
+        print(f"⚠️ Search index update failed for scan {scan.id}, retried at next startup: {e}")
+
+def reconcile_search_index():
+    # Index scans missing from the index (written before it existed or after a failed
+    # update) and drop rows whose scan no longer exists
+    scan_ids = {scan_id for (scan_id,) in db.session.query(Scan.id)}
+    indexed = search_index.indexed_scan_ids()
+    orphans = indexed - scan_ids
+    if orphans:
+        search_index.remove_scans(orphans)
+    missing = scan_ids - indexed
+    if missing:
+        for scan in Scan.query.yield_per(500):
+            if scan.id in missing:
+                index_scan(scan, json.loads(scan.result_json or "[]"))
+    print(f"🔎 Search index reconciled: {len(missing)} scan(s) indexed, {len(orphans)} removed")
+
+if not os.getenv("PYTEST_RUNNING"):
+    with app.app_context():
+        reconcile_search_index()
 
 # -------------------- CORS headers after_request --------------------
 @app.after_request
@@ -244,19 +775,49 @@ def scan_history():
         })
     return jsonify(result)
 
+@app.route("/books/search", methods=["GET"])
+@jwt_required()
+def search_books():
+    user_id = int(get_jwt_identity())
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "Missing search query 'q'"}), 400
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", 20, type=int), 1), 100)
+
+    total, results = search_index.search(user_id, query, page, per_page)
+    return jsonify({"query": query, "page": page, "per_page": per_page, "total": total, "results": results})
+
 @app.route("/delete-scans", methods=["POST"])
 @jwt_required()
 def delete_scans():
     try:
         data = request.get_json(silent=True) or {}
         ids = data.get("ids", [])
+        deleted = []
         for scan_id in ids:
             scan = Scan.query.get(scan_id)
             if scan:
-                db.session.delete(scan)
-        db.session.commit()
+                deleted.append(scan)
+        # A finalized resumable upload references its scan: drop the session first
+        UploadSession.query.filter(
+            UploadSession.scan_id.in_([scan.id for scan in deleted])
+        ).delete(synchronize_session=False)
+        for scan in deleted:
+            db.session.delete(scan)
+        # Unindex before committing: if either step fails, scans and index stay in sync
+        search_index.remove_scans([scan.id for scan in deleted])
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for scan in deleted:
+                index_scan(scan, json.loads(scan.result_json or "[]"))
+            raise
         return jsonify({"message": "Scans deleted successfully"}), 200
     except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error deleting scans: {e}")
         return jsonify({"error": str(e)}), 500
 
 # -------------------- API: Mobile Upload (JWT) --------------------
@@ -275,6 +836,8 @@ def upload_no_excel():
 
         books_structured = []
         image_paths = []
+        quality_report = []
+        deduplicator = LineDeduplicator()
 
         with ThreadPoolExecutor(max_workers=4) as executor:
             futures = []
@@ -286,24 +849,24 @@ def upload_no_excel():
                 f.save(upload_path)
                 print(f"📂 Saved file: {upload_path}")
 
-                if ext.lower() == ".heic":
-                    img_path = os.path.join(PROCESSED_FOLDER, name + ".png")
-                    convert_heic_to_png(upload_path, img_path)
-                else:
-                    img_path = upload_path
-
-                compressed_path = os.path.join(PROCESSED_FOLDER, name + ".jpg")
-                compress_image(img_path, compressed_path)
+                compressed_path = prepare_image(upload_path)
                 print(f"🖼️ Compressed: {compressed_path}")
 
                 image_paths.append(compressed_path)
 
-                text = extract_text_google_vision(compressed_path)
+                quality = assess_image_quality(compressed_path)
+                quality_report.append({"image": compressed_path, **quality})
+                if not quality["ok"]:
+                    print(f"🚫 Rejected {compressed_path}: {quality['reason']}")
+                    continue
+
+                text = extract_text(compressed_path)
                 lines = [l for l in text.split('\n') if len(l.strip()) > 10]
                 print(f"🔍 {len(lines)} lines extracted by OCR")
 
                 for line in lines:
-                    futures.append(executor.submit(parse_spine_line, line))
+                    if deduplicator.add(line)[1]:
+                        futures.append(executor.submit(parse_spine_line, line))
 
             for fut in as_completed(futures):
                 try:
@@ -313,6 +876,8 @@ def upload_no_excel():
                 except Exception as e:
                     print(f"⚠️ Error processing a line: {e}")
 
+        books_structured = merge_duplicate_books(books_structured)
+
         # Save history
         scan = Scan(
             user_id=current_user_id,
@@ -321,13 +886,250 @@ def upload_no_excel():
         )
         db.session.add(scan)
         db.session.commit()
+        index_scan(scan, books_structured)
 
-        return jsonify({"message": "Processing completed", "data": books_structured})
+        return jsonify({"message": "Processing completed", "data": books_structured, "quality": quality_report})
 
     except Exception as e:
         print(f"❌ Server error: {e}")
         return jsonify({"error": str(e)}), 500
 
+# -------------------- API: Resumable Upload (JWT) --------------------
+# Protocol: POST /uploads declares the files, PUT /uploads/<id>/files/<n>?offset=N
+# appends raw bytes, POST /uploads/<id>/finalize turns the session into a Scan.
+# Each image starts compression/OCR/parsing as soon as its last chunk lands.
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", str(32 * 1024 * 1024)))  # 32 MB
+UPLOAD_MAX_SESSION_SIZE = int(os.getenv("UPLOAD_MAX_SESSION_SIZE", str(256 * 1024 * 1024)))  # 256 MB
+UPLOAD_SESSION_TTL_HOURS = float(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+
+image_executor = ThreadPoolExecutor(max_workers=4)
+line_executor = ThreadPoolExecutor(max_workers=4)
+upload_jobs = {}  # (session_id, file_id) -> Future[(compressed_path, books, quality)]
+upload_deduplicators = {}  # session_id -> LineDeduplicator shared by the session's images
+upload_locks = {}  # session_id -> Lock serializing that session's chunk writes and finalize
+upload_locks_guard = threading.Lock()
+
+def upload_session_lock(session_id):
+    with upload_locks_guard:
+        return upload_locks.setdefault(session_id, threading.Lock())
+
+def process_uploaded_image(upload_path, deduplicator):
+    compressed_path = prepare_image(upload_path)
+    quality = assess_image_quality(compressed_path)
+    if not quality["ok"]:
+        print(f"🚫 Rejected {compressed_path}: {quality['reason']}")
+        return compressed_path, [], quality
+
+    text = extract_text(compressed_path)
+    lines = [l for l in text.split('\n') if len(l.strip()) > 10]
+    print(f"🔍 {len(lines)} lines extracted by OCR")
+    lines = [line for line in lines if deduplicator.add(line)[1]]
+    books = [book for book in line_executor.map(parse_spine_line, lines) if book]
+    return compressed_path, books, quality
+
+def sweep_stale_upload_sessions():
+    # Drop sessions that were never finalized within the TTL, with their partial files
+    cutoff = datetime.now().astimezone() - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    stale = UploadSession.query.filter(
+        UploadSession.scan_id.is_(None), UploadSession.timestamp < cutoff
+    ).all()
+    for session in stale:
+        with upload_session_lock(session.id):
+            for i, f in enumerate(json.loads(session.files_json)):
+                fut = upload_jobs.pop((session.id, i), None)
+                if fut:
+                    fut.cancel()
+                try:
+                    os.remove(f["path"])
+                except FileNotFoundError:
+                    pass
+            upload_deduplicators.pop(session.id, None)
+            db.session.delete(session)
+        with upload_locks_guard:
+            upload_locks.pop(session.id, None)
+    if stale:
+        db.session.commit()
+        print(f"🧹 Removed {len(stale)} stale upload session(s)")
+
+def received_bytes(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def get_user_upload_session(session_id):
+    session = db.session.get(UploadSession, session_id)
+    if not session or session.user_id != int(get_jwt_identity()):
+        return None
+    return session
+
+def upload_session_status(session):
+    files = json.loads(session.files_json)
+    return {
+        "session_id": session.id,
+        "finalized": session.scan_id is not None,
+        "files": [
+            {
+                "file_id": i,
+                "name": f["name"],
+                "size": f["size"],
+                "received": received_bytes(f["path"]),
+                "processed": session.scan_id is not None
+                or ((session.id, i) in upload_jobs and upload_jobs[(session.id, i)].done())
+            }
+            for i, f in enumerate(files)
+        ]
+    }
+
+@app.route("/uploads", methods=["POST"])
+@jwt_required()
+def create_upload_session():
+    sweep_stale_upload_sessions()
+
+    data = request.get_json(silent=True) or {}
+    declared = data.get("files")
+    if not declared or not isinstance(declared, list):
+        return jsonify({"error": "Send JSON with a non-empty 'files' list of {name, size}."}), 400
+
+    session_id = str(uuid.uuid4())
+    files = []
+    for f in declared:
+        name = str(f.get("name", "")) if isinstance(f, dict) else ""
+        size = f.get("size") if isinstance(f, dict) else None
+        if not name or not isinstance(size, int) or size <= 0:
+            return jsonify({"error": "Each file needs a 'name' and a positive integer 'size'."}), 400
+        if size > UPLOAD_MAX_FILE_SIZE:
+            return jsonify({"error": f"'{name}' exceeds the {UPLOAD_MAX_FILE_SIZE} byte file limit"}), 413
+        ext = os.path.splitext(name)[1]
+        path = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()) + ext)
+        files.append({"name": name, "size": size, "path": path})
+
+    if sum(f["size"] for f in files) > UPLOAD_MAX_SESSION_SIZE:
+        return jsonify({"error": f"Upload exceeds the {UPLOAD_MAX_SESSION_SIZE} byte session limit"}), 413
+
+    session = UploadSession(
+        id=session_id,
+        user_id=int(get_jwt_identity()),
+        files_json=json.dumps(files)
+    )
+    db.session.add(session)
+    db.session.commit()
+    return jsonify(upload_session_status(session)), 201
+
+@app.route("/uploads/<session_id>", methods=["GET"])
+@jwt_required()
+def get_upload_session(session_id):
+    session = get_user_upload_session(session_id)
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+    return jsonify(upload_session_status(session))
+
+@app.route("/uploads/<session_id>/files/<int:file_id>", methods=["PUT"])
+@jwt_required()
+def upload_chunk(session_id, file_id):
+    session = get_user_upload_session(session_id)
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+    if session.scan_id is not None:
+        return jsonify({"error": "Upload session already finalized"}), 409
+
+    files = json.loads(session.files_json)
+    if file_id < 0 or file_id >= len(files):
+        return jsonify({"error": "Unknown file_id"}), 404
+    entry = files[file_id]
+
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        return jsonify({"error": "Missing integer 'offset' query parameter"}), 400
+    chunk = request.get_data(cache=False)
+
+    with upload_session_lock(session_id):
+        received = received_bytes(entry["path"])
+        if offset != received:
+            # The client resumes from the offset we actually have on disk
+            return jsonify({"error": "Offset mismatch", "received": received}), 409
+        if offset + len(chunk) > entry["size"]:
+            return jsonify({"error": "Chunk exceeds declared file size", "received": received}), 400
+
+        with open(entry["path"], "ab") as out:
+            out.write(chunk)
+        received += len(chunk)
+
+        complete = received == entry["size"]
+        if complete and (session_id, file_id) not in upload_jobs:
+            print(f"📂 Upload complete: {entry['path']}")
+            deduplicator = upload_deduplicators.setdefault(session_id, LineDeduplicator())
+            upload_jobs[(session_id, file_id)] = image_executor.submit(process_uploaded_image, entry["path"], deduplicator)
+
+    return jsonify({"file_id": file_id, "received": received, "complete": complete})
+
+@app.route("/uploads/<session_id>/finalize", methods=["POST"])
+@jwt_required()
+def finalize_upload_session(session_id):
+    session = get_user_upload_session(session_id)
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+
+    # The session lock is held across check-and-create: a retry that overlaps a
+    # running finalize waits for it and then returns the same Scan.
+    with upload_session_lock(session_id):
+        db.session.refresh(session)
+        if session.scan_id is not None:
+            # Finalize is idempotent so a client can retry after losing the response
+            scan = db.session.get(Scan, session.scan_id)
+            if not scan:
+                return jsonify({"error": "The scan of this upload session was deleted"}), 410
+            return jsonify({"message": "Processing completed", "scan_id": scan.id,
+                            "data": json.loads(scan.result_json),
+                            "quality": json.loads(session.quality_json or "[]")})
+
+        files = json.loads(session.files_json)
+        incomplete = [i for i, f in enumerate(files) if received_bytes(f["path"]) != f["size"]]
+        if incomplete:
+            return jsonify({"error": "Upload incomplete", "incomplete_files": incomplete}), 409
+
+        try:
+            books_structured = []
+            image_paths = []
+            quality_report = []
+            for i, f in enumerate(files):
+                # Jobs are lost on restart: reprocess any file that has no job yet
+                if (session_id, i) not in upload_jobs:
+                    deduplicator = upload_deduplicators.setdefault(session_id, LineDeduplicator())
+                    upload_jobs[(session_id, i)] = image_executor.submit(process_uploaded_image, f["path"], deduplicator)
+                try:
+                    compressed_path, books, quality = upload_jobs[(session_id, i)].result()
+                    image_paths.append(compressed_path)
+                    quality_report.append({"image": compressed_path, **quality})
+                    books_structured.extend(books)
+                except Exception as e:
+                    print(f"⚠️ Error processing an image: {e}")
+
+            books_structured = merge_duplicate_books(books_structured)
+
+            scan = Scan(
+                user_id=session.user_id,
+                image_paths=json.dumps(image_paths),
+                result_json=json.dumps(books_structured)
+            )
+            db.session.add(scan)
+            db.session.flush()
+            session.scan_id = scan.id
+            session.quality_json = json.dumps(quality_report)
+            db.session.commit()
+            index_scan(scan, books_structured)
+
+            for i in range(len(files)):
+                upload_jobs.pop((session_id, i), None)
+            upload_deduplicators.pop(session_id, None)
+            with upload_locks_guard:
+                upload_locks.pop(session_id, None)
+
+            return jsonify({"message": "Processing completed", "scan_id": scan.id, "data": books_structured,
+                            "quality": quality_report})
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Server error: {e}")
+            return jsonify({"error": str(e)}), 500
+
 # -------------------- API: Web Upload (session login_required) --------------------
 @app.route("/upload", methods=["POST"])
 @login_required
@@ -338,6 +1140,7 @@ def upload():
 
     books_structured = []
     futures = []
+    deduplicator = LineDeduplicator()
 
     with ThreadPoolExecutor(max_workers=4) as executor:
         for f in files:
@@ -346,24 +1149,22 @@ def upload():
             upload_path = os.path.join(UPLOAD_FOLDER, name + ext)
             f.save(upload_path)
 
-            if ext.lower() == ".heic":
-                img_path = os.path.join(PROCESSED_FOLDER, name + ".png")
-                convert_heic_to_png(upload_path, img_path)
-            else:
-                img_path = upload_path
-
-            compressed_path = os.path.join(PROCESSED_FOLDER, name + ".jpg")
-            compress_image(img_path, compressed_path)
-            text = extract_text_google_vision(compressed_path)
+            compressed_path = prepare_image(upload_path)
+            if not assess_image_quality(compressed_path)["ok"]:
+                continue
+            text = extract_text(compressed_path)
             lines = [l for l in text.split('\n') if len(l.strip()) > 10]
             for line in lines:
-                futures.append(executor.submit(parse_spine_line, line))
+                if deduplicator.add(line)[1]:
+                    futures.append(executor.submit(parse_spine_line, line))
 
         for fut in as_completed(futures):
             result = fut.result()
             if result:
                 books_structured.append(result)
 
+    books_structured = merge_duplicate_books(books_structured)
+
     username = current_user.username.lower()
     user_folder = os.path.join(RESULT_FOLDER, username)
     os.makedirs(user_folder, exist_ok=True)
@@ -485,6 +1286,11 @@ def jwt_expired(jwt_header, jwt_payload):
 def me():
     return jsonify({"user_id": int(get_jwt_identity())})
 
+@app.route("/metrics/models", methods=["GET"])
+@jwt_required()
+def model_metrics():
+    return jsonify(model_stats_snapshot())
+
 @app.route("/health")
 def health():
     return jsonify({"ok": True})
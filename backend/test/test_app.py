@@ -3,14 +3,17 @@ import os
 import io
 import pytest
 from unittest.mock import patch
-from main import app, db, User, Scan, RESULT_FOLDER
+
+os.environ.setdefault("PYTEST_RUNNING", "1")  # no OpenAI client, no on-disk search index
+
+from main import app, db, User, Scan, RESULT_FOLDER, BookSearchIndex
 from werkzeug.security import generate_password_hash
 
 @pytest.fixture
-def client():
+def client(tmp_path):
     app.config['TESTING'] = True
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # DB en mémoire
-    with app.test_client() as client:
+    with app.test_client() as client, patch("main.search_index", BookSearchIndex(str(tmp_path / "search.db"))):
         with app.app_context():
             db.create_all()
         yield client
@@ -247,3 +250,501 @@ def test_appupload_with_mocked_ocr_and_gpt(mock_parse, mock_vision, mock_compres
     json_data = res.get_json()
     assert json_data["message"] == "Processing completed"
     assert any("Title" in book for book in json_data["data"])
+
+# ------------------ RESUMABLE UPLOAD TESTS ------------------
+
+def auth_header(client):
+    register_user(client)
+    token = login_user(client).get_json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+def test_upload_session_requires_files(client):
+    headers = auth_header(client)
+    res = client.post("/uploads", json={}, headers=headers)
+    assert res.status_code == 400
+
+@patch("main.compress_image", return_value=None)
+@patch("main.extract_text_google_vision", return_value="This is a fake book line with more than ten chars")
+@patch("main.parse_spine_line", return_value={"Title": "FakeBook", "Raw OCR Text": "fake"})
+def test_resumable_upload_flow(mock_parse, mock_vision, mock_compress, client):
+    headers = auth_header(client)
+    payload = b"0123456789abcdef"
+
+    res = client.post("/uploads", json={"files": [{"name": "shelf.jpg", "size": len(payload)}]}, headers=headers)
+    assert res.status_code == 201
+    session_id = res.get_json()["session_id"]
+    url = f"/uploads/{session_id}/files/0"
+
+    res = client.put(f"{url}?offset=0", data=payload[:6], headers=headers)
+    assert res.get_json() == {"file_id": 0, "received": 6, "complete": False}
+
+    # Finalizing before every byte has arrived is refused
+    res = client.post(f"/uploads/{session_id}/finalize", headers=headers)
+    assert res.status_code == 409
+
+    # A retried chunk with a stale offset reports where to resume
+    res = client.put(f"{url}?offset=0", data=payload[:6], headers=headers)
+    assert res.status_code == 409
+    assert res.get_json()["received"] == 6
+
+    res = client.put(f"{url}?offset=6", data=payload[6:], headers=headers)
+    assert res.get_json()["complete"] is True
+
+    res = client.post(f"/uploads/{session_id}/finalize", headers=headers)
+    assert res.status_code == 200
+    data = res.get_json()
+    assert data["data"][0]["Title"] == "FakeBook"
+
+    # Finalize is idempotent and the session is now closed for writes
+    res = client.post(f"/uploads/{session_id}/finalize", headers=headers)
+    assert res.get_json()["scan_id"] == data["scan_id"]
+    assert res.get_json()["quality"] == data["quality"]
+    status = client.get(f"/uploads/{session_id}", headers=headers).get_json()
+    assert status["finalized"] is True
+    assert status["files"][0]["processed"] is True
+    res = client.put(f"{url}?offset=16", data=b"x", headers=headers)
+    assert res.status_code == 409
+
+    with app.app_context():
+        assert Scan.query.count() == 1
+
+def test_upload_chunk_exceeding_declared_size(client):
+    headers = auth_header(client)
+    res = client.post("/uploads", json={"files": [{"name": "a.jpg", "size": 4}]}, headers=headers)
+    session_id = res.get_json()["session_id"]
+    res = client.put(f"/uploads/{session_id}/files/0?offset=0", data=b"too long", headers=headers)
+    assert res.status_code == 400
+
+# ------------------ QUALITY GATE TESTS ------------------
+
+def make_spine_image(path, blur=0, fill=(200, 190, 170)):
+    from PIL import Image, ImageDraw, ImageFilter
+    img = Image.new("RGB", (1600, 1200), fill)
+    draw = ImageDraw.Draw(img)
+    for y in range(0, 1200, 40):
+        draw.text((20, y), "THE LITTLE PRINCE  Antoine de Saint-Exupery  Gallimard " * 3, fill=(20, 20, 20))
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    img.save(path)
+    return str(path)
+
+def test_quality_gate_accepts_sharp_text(tmp_path):
+    from main import assess_image_quality
+    result = assess_image_quality(make_spine_image(tmp_path / "sharp.jpg"))
+    assert result["ok"] is True
+    assert result["reason"] is None
+
+def test_quality_gate_rejects_bad_images(tmp_path):
+    from main import assess_image_quality
+    assert assess_image_quality(make_spine_image(tmp_path / "blur.jpg", blur=8))["reason"] == "too_blurry"
+    assert assess_image_quality(make_spine_image(tmp_path / "dark.jpg", fill=(0, 0, 0)))["reason"] == "too_dark"
+
+def test_quality_gate_accepts_small_sharp_text_on_plain_background(tmp_path):
+    from PIL import Image, ImageDraw, ImageFont
+    from main import assess_image_quality
+    img = Image.new("RGB", (1600, 1200), (200, 190, 170))
+    ImageDraw.Draw(img).text((700, 580), "CAMUS", font=ImageFont.load_default(size=24), fill=(20, 20, 20))
+    img.save(tmp_path / "spine.jpg")
+    result = assess_image_quality(str(tmp_path / "spine.jpg"))
+    assert result["ok"] is True
+    assert result["low_confidence"] is True  # little text: flagged, not rejected
+    assert result["metrics"]["sharpness"] > 40
+
+@patch("main.compress_image", return_value=None)
+@patch("main.assess_image_quality", return_value={"ok": False, "reason": "too_blurry", "low_confidence": False, "metrics": {}})
+@patch("main.extract_text_google_vision")
+def test_appupload_skips_ocr_for_rejected_image(mock_vision, mock_quality, mock_compress, client):
+    headers = auth_header(client)
+    data = {"images": (io.BytesIO(b"fake image data"), "blurry.jpg")}
+    res = client.post("/appUpload", data=data, content_type="multipart/form-data", headers=headers)
+    assert res.status_code == 200
+    json_data = res.get_json()
+    assert json_data["data"] == []
+    assert json_data["quality"][0]["reason"] == "too_blurry"
+    mock_vision.assert_not_called()
+
+# ------------------ DEDUPLICATION TESTS ------------------
+
+def test_line_deduplicator_clusters_near_duplicates():
+    from main import LineDeduplicator
+    dedup = LineDeduplicator()
+    assert dedup.add("LE PETIT PRINCE Antoine de Saint-Exupéry")[1] is True
+    assert dedup.add("Le Petit Prince  antoine de saint exupery")[1] is False
+    assert dedup.add("LE PETIT PRlNCE Antoine de Saint-Exupery")[1] is False  # OCR noise
+    assert dedup.add("Les Misérables Victor Hugo Pocket")[1] is True
+    assert len(dedup.clusters) == 2
+    assert len(dedup.clusters[0]) == 3
+
+def test_merge_duplicate_books_fills_missing_fields():
+    from main import merge_duplicate_books
+    books = [
+        {"Title": "The Stranger", "Author(s)": "Albert Camus", "ISBN": "", "Publisher": "..."},
+        {"Title": "the stranger", "Author(s)": "Albert Camus", "ISBN": "978-2070360022", "Publisher": "Gallimard"},
+        {"Title": "Les Misérables", "Author(s)": "Victor Hugo", "ISBN": "9782266234913"},
+        {"Title": "Les Miserables", "Author(s)": "V. Hugo", "ISBN": "9782266234913"},
+    ]
+    merged = merge_duplicate_books(books)
+    assert len(merged) == 2
+    assert merged[0]["ISBN"] == "978-2070360022"
+    assert merged[0]["Publisher"] == "Gallimard"
+
+@patch("main.compress_image", return_value=None)
+@patch("main.extract_text_google_vision", return_value="THE LITTLE PRINCE Saint-Exupery\nThe Little Prince  Saint Exupery")
+@patch("main.parse_spine_line", return_value={"Title": "The Little Prince", "Author(s)": "Saint-Exupery", "ISBN": "9782070612758"})
+def test_appupload_parses_duplicate_lines_once(mock_parse, mock_vision, mock_compress, client):
+    headers = auth_header(client)
+    data = {"images": [(io.BytesIO(b"fake"), "a.jpg"), (io.BytesIO(b"fake"), "b.jpg")]}
+    res = client.post("/appUpload", data=data, content_type="multipart/form-data", headers=headers)
+    assert res.status_code == 200
+    assert mock_parse.call_count == 1
+    assert len(res.get_json()["data"]) == 1
+
+# ------------------ MODEL ROUTING TESTS ------------------
+
+def fake_completion(content, prompt_tokens=50, completion_tokens=20):
+    from unittest.mock import MagicMock
+    response = MagicMock()
+    response.choices[0].message.content = content
+    response.usage.prompt_tokens = prompt_tokens
+    response.usage.completion_tokens = completion_tokens
+    return response
+
+def test_parse_spine_line_uses_fast_tier_for_easy_line():
+    from main import parse_spine_line, MODEL_TIERS
+    with patch("main.client") as mock_client:
+        mock_client.chat.completions.create.return_value = fake_completion(
+            json.dumps({"Title": "The Stranger", "Author(s)": "Albert Camus", "Confidence": 0.95}))
+        result = parse_spine_line("The Stranger Albert Camus")
+    assert result["Title"] == "The Stranger"
+    assert "Confidence" not in result
+    kwargs = mock_client.chat.completions.create.call_args.kwargs
+    assert kwargs["model"] == MODEL_TIERS[0][1]
+    assert kwargs["response_format"] == {"type": "json_object"}
+
+def test_parse_spine_line_escalates_on_low_confidence_and_bad_json():
+    from main import parse_spine_line, MODEL_TIERS
+    with patch("main.client") as mock_client:
+        mock_client.chat.completions.create.side_effect = [
+            fake_completion(json.dumps({"Title": "Stranger?", "Confidence": 0.2})),
+            fake_completion(json.dumps({"Title": "The Stranger", "Confidence": 0.9})),
+        ]
+        result = parse_spine_line("The Stranger Albert Camus")
+        assert result["Title"] == "The Stranger"
+        assert mock_client.chat.completions.create.call_args.kwargs["model"] == MODEL_TIERS[1][1]
+
+        mock_client.chat.completions.create.side_effect = [fake_completion("not json"), fake_completion("{oops")]
+        assert parse_spine_line("The Stranger Albert Camus") is None
+
+def test_model_metrics_endpoint(client):
+    assert client.get("/metrics/models").status_code == 401
+    res = client.get("/metrics/models", headers=auth_header(client))
+    assert res.status_code == 200
+    data = res.get_json()
+    assert set(data) == {"fast", "large"}
+    assert "median_latency_ms" in data["fast"]
+
+# ------------------ OCR BACKEND TESTS ------------------
+
+def test_extract_text_tesseract_picks_best_rotation(tmp_path):
+    from PIL import Image
+    from main import extract_text_tesseract
+    path = tmp_path / "spine.jpg"
+    Image.new("RGB", (100, 400), (255, 255, 255)).save(path)
+
+    def fake_data(words, conf):
+        return {"text": words, "conf": [conf] * len(words), "block_num": [1] * len(words),
+                "par_num": [1] * len(words), "line_num": list(range(len(words)))}
+
+    with patch("main.pytesseract") as mock_tess:
+        mock_tess.image_to_data.side_effect = [fake_data(["~~", "#"], 20), fake_data(["LE", "PETIT"], 90)]
+        text, confidence = extract_text_tesseract(str(path))
+    assert text == "LE\nPETIT"
+    assert confidence == 0.9
+    assert mock_tess.image_to_data.call_count == 2  # stops once confident
+
+@patch("main.OCR_BACKEND", "auto")
+@patch("main.extract_text_google_vision", return_value="vision text")
+def test_extract_text_auto_falls_back_to_vision(mock_vision):
+    from main import extract_text
+    with patch("main.extract_text_tesseract", return_value=("local text", 0.95)):
+        assert extract_text("img.jpg") == "local text"
+    mock_vision.assert_not_called()
+    with patch("main.extract_text_tesseract", return_value=("l0cal t3xt", 0.3)):
+        assert extract_text("img.jpg") == "vision text"
+    with patch("main.extract_text_tesseract", side_effect=RuntimeError("no tesseract")):
+        assert extract_text("img.jpg") == "vision text"
+
+@patch("main.OCR_BACKEND", "tesseract")
+@patch("main.extract_text_google_vision")
+def test_extract_text_tesseract_backend_never_calls_vision(mock_vision):
+    from main import extract_text
+    with patch("main.extract_text_tesseract", return_value=("l0cal t3xt", 0.1)):
+        assert extract_text("img.jpg") == "l0cal t3xt"
+    mock_vision.assert_not_called()
+
+# ------------------ SEARCH TESTS ------------------
+
+@pytest.fixture
+def fresh_search_index(tmp_path):
+    with patch("main.search_index", BookSearchIndex(str(tmp_path / "search.db"))) as index:
+        yield index
+
+def test_search_index_prefix_ranking_and_ownership(fresh_search_index):
+    fresh_search_index.add_scan(1, 1, [
+        {"Title": "Les Misérables", "Author(s)": "Victor Hugo", "Publisher": "Pocket", "ISBN": "978-2266234913"},
+        {"Title": "Notre-Dame de Paris", "Author(s)": "Victor Hugo", "Publisher": "...", "ISBN": ""},
+    ])
+    fresh_search_index.add_scan(2, 2, [{"Title": "Les Misérables", "Author(s)": "Victor Hugo"}])
+
+    total, results = fresh_search_index.search(1, "miser")
+    assert total == 1
+    assert results[0]["book"]["Title"] == "Les Misérables"
+
+    assert fresh_search_index.search(1, "hug")[0] == 2
+    assert fresh_search_index.search(1, "9782266")[0] == 1
+    assert fresh_search_index.search(2, "u1")[0] == 0
+    assert len(fresh_search_index.search(1, "hugo", page=2, per_page=1)[1]) == 1
+
+    fresh_search_index.remove_scans([1])
+    assert fresh_search_index.search(1, "hugo")[0] == 0
+    assert fresh_search_index.search(2, "hugo")[0] == 1
+
+@patch("main.compress_image", return_value=None)
+@patch("main.extract_text_google_vision", return_value="The Stranger Albert Camus Gallimard")
+@patch("main.parse_spine_line", return_value={"Title": "The Stranger", "Author(s)": "Albert Camus", "Publisher": "Gallimard", "ISBN": "9782070360022"})
+def test_search_endpoint_follows_upload_and_delete(mock_parse, mock_vision, mock_compress, client):
+    headers = auth_header(client)
+    res = client.get("/books/search", headers=headers)
+    assert res.status_code == 400
+
+    data = {"images": (io.BytesIO(b"fake image data"), "shelf.jpg")}
+    client.post("/appUpload", data=data, content_type="multipart/form-data", headers=headers)
+
+    res = client.get("/books/search?q=camu", headers=headers)
+    assert res.status_code == 200
+    body = res.get_json()
+    assert body["total"] == 1
+    scan_id = body["results"][0]["scan_id"]
+    assert body["results"][0]["book"]["Title"] == "The Stranger"
+
+    client.post("/delete-scans", json={"ids": [scan_id]}, headers=headers)
+    res = client.get("/books/search?q=camu", headers=headers)
+    assert res.get_json()["total"] == 0
+
+@patch("main.compress_image", return_value=None)
+@patch("main.extract_text_google_vision", return_value="This is a fake book line with more than ten chars")
+def test_concurrent_finalize_creates_one_scan(mock_vision, mock_compress, client):
+    import threading
+    import time
+
+    def slow_parse(line):
+        time.sleep(0.2)
+        return {"Title": "FakeBook", "Raw OCR Text": line}
+
+    headers = auth_header(client)
+    res = client.post("/uploads", json={"files": [{"name": "shelf.jpg", "size": 4}]}, headers=headers)
+    session_id = res.get_json()["session_id"]
+
+    scan_ids = []
+    with patch("main.parse_spine_line", side_effect=slow_parse):
+        client.put(f"/uploads/{session_id}/files/0?offset=0", data=b"data", headers=headers)
+
+        def finalize():
+            with app.test_client() as c:
+                scan_ids.append(c.post(f"/uploads/{session_id}/finalize", headers=headers).get_json()["scan_id"])
+
+        threads = [threading.Thread(target=finalize) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert len(scan_ids) == 2 and scan_ids[0] == scan_ids[1]
+    with app.app_context():
+        assert Scan.query.count() == 1
+
+def test_upload_session_size_limits(client):
+    headers = auth_header(client)
+    with patch("main.UPLOAD_MAX_FILE_SIZE", 10), patch("main.UPLOAD_MAX_SESSION_SIZE", 15):
+        res = client.post("/uploads", json={"files": [{"name": "a.jpg", "size": 11}]}, headers=headers)
+        assert res.status_code == 413
+        res = client.post("/uploads", json={"files": [{"name": "a.jpg", "size": 8}, {"name": "b.jpg", "size": 8}]},
+                          headers=headers)
+        assert res.status_code == 413
+
+def test_stale_upload_sessions_are_swept(client):
+    from datetime import timedelta
+    from main import UploadSession
+    headers = auth_header(client)
+    res = client.post("/uploads", json={"files": [{"name": "a.jpg", "size": 8}]}, headers=headers)
+    session_id = res.get_json()["session_id"]
+    client.put(f"/uploads/{session_id}/files/0?offset=0", data=b"part", headers=headers)
+
+    with app.app_context():
+        session = db.session.get(UploadSession, session_id)
+        partial_path = json.loads(session.files_json)[0]["path"]
+        session.timestamp = session.timestamp - timedelta(days=2)
+        db.session.commit()
+    assert os.path.exists(partial_path)
+
+    client.post("/uploads", json={"files": [{"name": "b.jpg", "size": 8}]}, headers=headers)
+    assert client.get(f"/uploads/{session_id}", headers=headers).status_code == 404
+    assert not os.path.exists(partial_path)
+
+def test_line_deduplicator_keeps_series_volumes_apart():
+    from main import LineDeduplicator
+    dedup = LineDeduplicator()
+    for tome in ("1", "2", "3"):
+        assert dedup.add(f"Harry Potter Tome {tome} Gallimard")[1] is True
+    assert dedup.add("Encyclopaedia Universalis Volume 12")[1] is True
+    assert dedup.add("Encyclopaedia Universalis Volume 13")[1] is True
+    assert dedup.add("Les Rois maudits Tome II Maurice Druon")[1] is True
+    assert dedup.add("Les Rois maudits Tome III Maurice Druon")[1] is True
+    assert dedup.add("HARRY POTTER Tome 2 - Gallimard")[1] is False
+    assert len(dedup.clusters) == 7
+
+def test_parse_spine_line_handles_non_object_json_and_string_confidence():
+    from main import parse_spine_line, MODEL_TIERS
+    with patch("main.client") as mock_client:
+        mock_client.chat.completions.create.side_effect = [fake_completion("[1, 2]"), fake_completion('"text"')]
+        assert parse_spine_line("The Stranger Albert Camus") is None
+
+        mock_client.chat.completions.create.side_effect = None
+        mock_client.chat.completions.create.return_value = fake_completion(
+            json.dumps({"Title": "The Stranger", "Confidence": "0.9"}))
+        result = parse_spine_line("The Stranger Albert Camus")
+    assert result["Title"] == "The Stranger"
+    assert mock_client.chat.completions.create.call_args.kwargs["model"] == MODEL_TIERS[0][1]
+
+def test_reconcile_search_index_repairs_drift(client):
+    import main
+    with app.app_context():
+        user = User(username="reader", password=generate_password_hash("pw"))
+        db.session.add(user)
+        db.session.commit()
+        scan = Scan(user_id=user.id, image_paths=json.dumps([]),
+                    result_json=json.dumps([{"Title": "The Plague", "Author(s)": "Albert Camus"}]))
+        db.session.add(scan)
+        db.session.commit()
+        main.search_index.add_scan(999, user.id, [{"Title": "Deleted Book"}])
+
+        empty_scan = Scan(user_id=user.id, image_paths=json.dumps([]), result_json=json.dumps([]))
+        db.session.add(empty_scan)
+        db.session.commit()
+
+        main.reconcile_search_index()
+        assert main.search_index.indexed_scan_ids() == {scan.id, empty_scan.id}
+        assert main.search_index.search(user.id, "plague")[0] == 1
+
+        # Nothing is missing any more, so a second pass does not walk the Scan table
+        with patch("main.index_scan") as mock_index:
+            main.reconcile_search_index()
+        mock_index.assert_not_called()
+        main.search_index.add_scan(scan.id, user.id, [{"Title": "The Plague"}])
+        assert main.search_index.search(user.id, "plague")[0] == 1  # re-adding is a no-op
+
+def test_delete_scans_keeps_scan_when_unindexing_fails(client):
+    headers = auth_header(client)
+    with app.app_context():
+        user = User.query.filter_by(username="testuser").first()
+        scan = Scan(user_id=user.id, image_paths=json.dumps([]), result_json=json.dumps([]))
+        db.session.add(scan)
+        db.session.commit()
+        scan_id = scan.id
+
+    with patch("main.search_index.remove_scans", side_effect=RuntimeError("index locked")):
+        res = client.post("/delete-scans", json={"ids": [scan_id]}, headers=headers)
+    assert res.status_code == 500
+    with app.app_context():
+        assert db.session.get(Scan, scan_id) is not None
+
+@patch("main.compress_image", return_value=None)
+@patch("main.extract_text_google_vision", return_value="This is a fake book line with more than ten chars")
+@patch("main.parse_spine_line", return_value={"Title": "FakeBook", "Raw OCR Text": "fake"})
+def test_delete_scan_of_finalized_upload_with_foreign_keys(mock_parse, mock_vision, mock_compress, client):
+    from sqlalchemy import text
+    headers = auth_header(client)
+    res = client.post("/uploads", json={"files": [{"name": "a.jpg", "size": 4}]}, headers=headers)
+    session_id = res.get_json()["session_id"]
+    client.put(f"/uploads/{session_id}/files/0?offset=0", data=b"data", headers=headers)
+    scan_id = client.post(f"/uploads/{session_id}/finalize", headers=headers).get_json()["scan_id"]
+
+    with app.app_context():
+        db.session.execute(text("PRAGMA foreign_keys=ON"))
+    try:
+        res = client.post("/delete-scans", json={"ids": [scan_id]}, headers=headers)
+        assert res.status_code == 200
+    finally:
+        with app.app_context():
+            db.session.execute(text("PRAGMA foreign_keys=OFF"))
+    with app.app_context():
+        assert db.session.get(Scan, scan_id) is None
+    assert client.post(f"/uploads/{session_id}/finalize", headers=headers).status_code == 404
+
+@patch("main.compress_image", return_value=None)
+@patch("main.extract_text_google_vision", return_value="This is a fake book line with more than ten chars")
+@patch("main.parse_spine_line", return_value={"Title": "FakeBook", "Raw OCR Text": "fake"})
+def test_finalize_retry_after_scan_removed(mock_parse, mock_vision, mock_compress, client):
+    headers = auth_header(client)
+    res = client.post("/uploads", json={"files": [{"name": "a.jpg", "size": 4}]}, headers=headers)
+    session_id = res.get_json()["session_id"]
+    client.put(f"/uploads/{session_id}/files/0?offset=0", data=b"data", headers=headers)
+    scan_id = client.post(f"/uploads/{session_id}/finalize", headers=headers).get_json()["scan_id"]
+
+    # Simulate the scan disappearing while the session still points at it
+    with app.app_context():
+        db.session.delete(db.session.get(Scan, scan_id))
+        db.session.commit()
+
+    res = client.post(f"/uploads/{session_id}/finalize", headers=headers)
+    assert res.status_code == 410
+    assert "deleted" in res.get_json()["error"]
+
+def test_line_deduplicator_merges_french_elision_noise():
+    from main import LineDeduplicator
+    dedup = LineDeduplicator()
+    assert dedup.add("L'Étranger Albert Camus Gallimard")[1] is True
+    assert dedup.add("LEtranger Albert Camus Gallimard")[1] is False
+    assert dedup.add("L Etranger Albert Camus Gallimard")[1] is False
+    assert dedup.add("à l'école des sorciers")[1] is True
+    assert dedup.add("à lécole des sorciers")[1] is False
+    assert dedup.add("Le Comte de Monte-Cristo Tome A")[1] is True
+    assert dedup.add("Le Comte de Monte-Cristo Tome B")[1] is True
+    assert len(dedup.clusters) == 4
+
+def test_check_ocr_backend_fails_fast_for_tesseract():
+    from main import check_ocr_backend
+    with patch("main.OCR_BACKEND", "tesseract"):
+        with patch("main.pytesseract", None):
+            with pytest.raises(RuntimeError, match="pytesseract is not installed"):
+                check_ocr_backend()
+        with patch("main.pytesseract") as mock_tess:
+            mock_tess.get_tesseract_version.side_effect = OSError("tesseract not found")
+            with pytest.raises(RuntimeError, match="binary"):
+                check_ocr_backend()
+        with patch("main.pytesseract") as mock_tess, patch("main.OCR_TESSERACT_LANG", "eng+fra"):
+            mock_tess.get_languages.return_value = ["eng", "osd"]
+            with pytest.raises(RuntimeError, match="fra"):
+                check_ocr_backend()
+            mock_tess.get_languages.return_value = ["eng", "fra"]
+            check_ocr_backend()
+    with patch("main.OCR_BACKEND", "auto"), patch("main.pytesseract", None):
+        check_ocr_backend()  # auto degrades to Vision instead of failing
+    with patch("main.OCR_BACKEND", "bogus"):
+        with pytest.raises(ValueError):
+            check_ocr_backend()
+
+def test_extract_text_uses_registered_engine():
+    from main import extract_text
+    with patch.dict("main.OCR_ENGINES", {"fake": lambda path: ("fake text", 1.0)}), patch("main.OCR_BACKEND", "fake"):
+        assert extract_text("img.jpg") == "fake text"
+
+def test_search_does_not_wait_for_index_writes(fresh_search_index):
+    import threading
+    fresh_search_index.add_scan(1, 1, [{"Title": "La Peste", "Author(s)": "Albert Camus"}])
+    results = []
+    with fresh_search_index.lock:  # an upload is being indexed
+        reader = threading.Thread(target=lambda: results.append(fresh_search_index.search(1, "peste")))
+        reader.start()
+        reader.join(timeout=2)
+    assert results and results[0][0] == 1